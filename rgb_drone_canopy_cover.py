@@ -7,20 +7,22 @@ Purpose: Analyze the canopy cover percentage of plots over a field.
 
 import sys
 import numpy as np
-import pandas as pd
 import geopandas
 import fiona
 import rasterio
-import rasterio.mask
-import json
+import rasterio.errors
+import rasterio.features
+import rasterio.windows
+import csv
 import cv2
 import glob
 import os
 import yaml
 import argparse
 import matplotlib.pyplot as plt
-from plantcv import plantcv as pcv
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from shapely.geometry import mapping
 from matplotlib.colors import hsv_to_rgb
 
 
@@ -73,163 +75,204 @@ def read_geojson():
     return gdf
 
 
-def create_dataframe():
-    """
-    Creates and returns dataframe to be outputted into the CSV file.
-    """
-    return pd.DataFrame(columns=["Date", "ID", "Percentage"])
-
-
-def crop_plot(gdf, id, src, plots_directory):
+def crop_plot(shape, id, src, plots_directory, save=False, out=None):
     """
     Finds geospacial information about the plot to be cropped from the larger field tif and
-    saves the cropped image as a tif file.
+    returns the cropped raster array, optionally saving it as a tif file.
 
     Input:
-        - gdf: geopandas dataframe with geojson information of the plots
+        - shape: list with the geojson geometry of the plot
         - id: int of the plot number
         - src: raster image file
         - plots_directory: string for directory to save the cropped plot image
+        - save: bool, write the cropped plot to a tif file when True
+        - out: optional preallocated numpy buffer to read the window into
 
-    Output:
-        - cropped plot saved in tif format
+    Return value:
+        - tuple of the cropped plot as a numpy array of shape
+          (bands, height, width) and the int pixel area of the plot polygon;
+          a plot whose window is empty comes back with pixel area 0
     """
-    # Get the row of that plot by id and convert to json
-    a = gdf[gdf['id'] == id].to_json()
-
-    # Load json object
-    json_object = json.loads(a)
-
-    # Create shape list
-    shape = [json_object['features'][0]['geometry']]
-
-    out_image, out_transform = rasterio.mask.mask(src, shape, crop=True)
-    out_meta = src.meta
-
-    # Save the resulting raster  
-    out_meta.update({"driver": "GTiff",
-                    "height": out_image.shape[1],
-                    "width": out_image.shape[2],
-                    "transform": out_transform})
-
-    # Save plot image to plots_directory by id
-    with rasterio.open(plots_directory + f"plot_{id}.tif", "w", **out_meta) as dest:
-        dest.write(out_image)
-
-
-def rotate_plot(plots_directory, id):
+    # Read just the window covering the plot bounds instead of going through
+    # rasterio's general-purpose mask path, which decodes every tile
+    # spanning the geometry's bounds on each call
+    window = rasterio.windows.from_bounds(*rasterio.features.bounds(shape[0]),
+                                          transform=src.transform)
+    window = window.round_offsets().round_lengths()
+
+    # Clip plots on the field edge to the raster extent; src.read would clip
+    # them anyway, and the transform must match the data actually read. A
+    # sliver polygon can round to a zero-size window (or miss the raster
+    # entirely), which makes the intersection empty; report it as a
+    # zero-area plot instead of crashing the worker
+    try:
+        window = window.intersection(rasterio.windows.Window(0, 0, src.width, src.height))
+    except rasterio.errors.WindowError:
+        return np.empty((src.count, 0, 0), dtype=src.dtypes[0]), 0
+
+    if out is not None:
+        # Recycle the caller's buffer instead of allocating a fresh
+        # (bands, height, width) array per plot
+        height, width = int(window.height), int(window.width)
+        out_image = src.read(window=window, out=out[:, :height, :width])
+    else:
+        out_image = src.read(window=window)
+
+    out_transform = src.window_transform(window)
+
+    # Rasterize the plot polygon over the small window buffer and zero out
+    # the pixels that fall outside it
+    mask = rasterio.features.geometry_mask(shape, out_image.shape[1:],
+                                           transform=out_transform, invert=True)
+    out_image *= mask
+
+    if save:
+        out_meta = src.meta
+
+        # Save the resulting raster
+        out_meta.update({"driver": "GTiff",
+                        "height": out_image.shape[1],
+                        "width": out_image.shape[2],
+                        "transform": out_transform})
+
+        # Save plot image to plots_directory by id
+        with rasterio.open(plots_directory + f"plot_{id}.tif", "w", **out_meta) as dest:
+            dest.write(out_image)
+
+    # The inverted mask marks exactly the in-polygon pixels, so its sum is
+    # the plot's true pixel area
+    return out_image, int(mask.sum())
+
+
+def rotate_plot(img):
     """
-    Rotates the plot image if the image is not straight. 
+    Rotates the plot image if the image is not straight.
 
     Input:
-        - plots_directory: string for directory to save the cropped plot image
-        - id: int of the plot number
+        - img: numpy array of the cropped plot
 
-    Output:
-        - rotated plot image saved both as tif and png
+    Return value:
+        - rotated image (numpy array) cropped to its non-black bounding box
     """
 
-    # read image file 
-    img, path, filename = pcv.readimage(filename = plots_directory + f"plot_{id}.tif")
-
-    # row, and col count how many rows and columns there are from 
-    # top left corner until a colored (non-black) pixel is found, respectively. 
-    row, col, offset = 0, 0, 1
+    # row, and col count how many rows and columns there are from
+    # top left corner until a colored (non-black) pixel is found, respectively.
+    offset = 1
 
-    # create numpy array with rgb for black (0, 0, 0) to use for comparisons
-    black = np.zeros((1,3), dtype = np.int8)
+    # find the first non-black pixel along the offset row/column with
+    # vectorized reductions instead of per-pixel comparisons
+    nonblack_in_row = img[offset].any(axis=-1)
+    nonblack_in_col = img[:, offset].any(axis=-1)
 
-    for i in range(len(img[0])):
-        if not np.array_equal(img[offset][i], black[0]):
-            col = i
-            break
-
-    for j in range(len(img)):
-        if not np.array_equal(img[j][offset], black[0]):
-            row = j
-            break
+    # argmax returns 0 both for a hit at index 0 and for an all-black
+    # row/column, so fall back to 0 explicitly in the latter case
+    col = int(np.argmax(nonblack_in_row)) if nonblack_in_row.any() else 0
+    row = int(np.argmax(nonblack_in_col)) if nonblack_in_col.any() else 0
 
     # calculate the angle by which the image is rotated
     ratio = (col - offset)/(row - offset)
     angle = np.arctan(ratio) * 180 / np.pi
 
-    input_image = Image.open(plots_directory + f"plot_{id}.tif")
+    # rotate the array in place with OpenCV instead of re-opening the tif
+    # with PIL; positive angles rotate counter-clockwise in both
+    height, width = img.shape[:2]
+    M = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    rotated = cv2.warpAffine(img, M, (width, height), flags=cv2.INTER_LINEAR, borderValue=0)
 
-    # rotate image
-    output = input_image.rotate(angle)
+    # crop to the bounding box of the non-black pixels
+    rows, cols = np.where(rotated.any(axis=-1))
+    if rows.size:
+        rotated = rotated[rows.min():rows.max() + 1, cols.min():cols.max() + 1]
 
-    # save image
-    im2 = output.crop(output.getbbox())
-    im2.save(plots_directory + f"plot_{id}_rotated_cropped.tif")
-    im2.save(plots_directory + f"plot_{id}_rotated_cropped.png")
+    return rotated
 
 
-def mask_image(image_name):
+def count_green_pixels(image, lower, upper):
     """
-    Masks out the bakground of the image leaving only th green pixels that fall in the 
-    range given by lower and upper. 
+    Counts the green pixels of the image, i.e. the pixels whose HSV values fall
+    in the range given by lower and upper.
 
     Input:
-        - image_name: string with file to be opened and masked
-    
+        - image: numpy array of the image in RGB channel order
+        - lower: numpy uint8 array with the lower hsv bound for green
+        - upper: numpy uint8 array with the upper hsv bound for green
+
     Return value:
-        - image (numpy array) with white background 
+        - int of the number of green pixels
     """
-    lower = tuple(dictionary['color']['lower'])
-    upper = tuple(dictionary['color']['upper'])
-
-    image = cv2.imread(image_name)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    
     hsv_image = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
-    
+
     mask = cv2.inRange(hsv_image, lower, upper)
-    
-    result = cv2.bitwise_and(image, image, mask=mask)
-    
-    result[np.where((result==[0,0,0]).all(axis=2))] = [255,255,255]
 
-    return result
+    # The mask already marks exactly the in-range pixels, so count it directly
+    # instead of painting the background white and rescanning the image.
+    return cv2.countNonZero(mask)
 
 
-def get_pixel_percent(image, total_pixel):
-    """
-    Returns the percentage of non-white pixels to all pixels.
+# Per-worker state set up by init_worker: one open rasterio handle and one
+# read buffer shared across all the plots that worker processes
+worker_src = None
+worker_buf = None
 
-    Input:
-        - image: numpy array of all pixels of an image
-        - total_pixel: int for total pixels (set by the first processed plot's size)
 
+def init_worker(raster_image_path, buffer_shape, buffer_dtype):
     """
-    # Count non-white pixels.
-    white = np.array([255, 255, 255])
-    
-    count, total = 0, 0
-    for i in range(len(image)):
-        for j in range(len(image[0])):
-            if not np.array_equal(white, image[i][j]):
-                count += 1
-            total += 1
-
-    # calculate percentage, the total pixels are determined by the first image's size
-    percent = count/total_pixel*100
+    Initializes a worker process: opens the scan-date raster once and
+    preallocates a read buffer large enough for any plot window, so the
+    per-plot reads recycle one handle and one allocation. Both live for the
+    lifetime of the worker and are released when it exits.
 
-    return percent
+    Input:
+        - raster_image_path: string with the path of the scan-date tif
+        - buffer_shape: tuple of (bands, height, width) for the read buffer
+        - buffer_dtype: numpy dtype of the raster bands
+    """
+    global worker_src, worker_buf
+    worker_src = rasterio.open(raster_image_path)
+    worker_buf = np.empty(buffer_shape, dtype=buffer_dtype)
 
 
-def write_to_file(df):
+def process_plot(id, geom, plots_directory, lower, upper, image_rotated, save):
     """
-    Writes data frame to csv file.
+    Crops, optionally rotates, and counts the green pixels of a single plot.
+    Runs in a worker process, using the rasterio handle and read buffer
+    opened by init_worker.
 
     Input:
-        - df: dataframe to be written to output file
+        - id: int of the plot number
+        - geom: geojson geometry of the plot
+        - plots_directory: string for directory to save the cropped plot image
+        - lower: numpy uint8 array with the lower hsv bound for green
+        - upper: numpy uint8 array with the upper hsv bound for green
+        - image_rotated: bool, set straight plots that are rotated
+        - save: bool, write intermediate plot images to disk when True
 
-    Output:
-        - csv file 
+    Return value:
+        - tuple of (id, green pixel count, pixel area of the plot polygon)
     """
-    dates_dir = dictionary['files']['dates_dir']
-    csv_name = dictionary['files']['csv_name']
-    df.to_csv(dates_dir + "/" + csv_name)
+    out_image, total_pixel = crop_plot([geom], id, worker_src, plots_directory,
+                                       save=save, out=worker_buf)
+
+    # A zero-area plot has nothing to rotate or count; hand it straight back
+    # so main can warn and write its empty row
+    if total_pixel == 0:
+        return id, 0, 0
+
+    # rasterio returns (bands, height, width) in RGB band order; rearrange to
+    # (height, width, channel) and keep RGB — the masker converts RGB to HSV
+    # directly, so no channel reversal is needed
+    image = np.transpose(out_image[:3], (1, 2, 0)).copy()
+
+    if image_rotated:
+        image = rotate_plot(image)
+
+        if save:
+            # cv2.imwrite expects BGR, so reverse the channels only here
+            cv2.imwrite(plots_directory + f"plot_{id}_rotated_cropped.tif", image[:, :, ::-1])
+
+    count = count_green_pixels(image, lower, upper)
+
+    return id, count, total_pixel
 
 
 def main():
@@ -241,64 +284,101 @@ def main():
         global dictionary
         dictionary = yaml.safe_load(stream)
 
+    # Hoist the per-plot yaml lookups out of the loops; the hsv bounds are
+    # precomputed once as uint8 arrays for cv2.inRange
+    lower = np.array(dictionary['color']['lower'], dtype=np.uint8)
+    upper = np.array(dictionary['color']['upper'], dtype=np.uint8)
+    image_rotated = dictionary['image_correction']['image_rotated']
+    plots_dir_name = dictionary['files']['plots_dir_name']
+
     images = get_all_directories()
 
     gdf = read_geojson()
 
-    df = create_dataframe()
-
-    total_pixel = 0
-    total_pixel_set = False
-    
-    # loop over all the scan-dates
-    for raster_image_path in images:
-        date = np.datetime64(os.path.basename(os.path.dirname(raster_image_path)))
-        plots_directory = os.path.dirname(raster_image_path) + dictionary['files']['plots_dir_name']
-        
-        if not os.path.exists(plots_directory):
-            os.makedirs(plots_directory)
-
-        output_str = ''
-    
-        with rasterio.open(raster_image_path) as src:
-            # Check if the CRS match
-            assert str(src.crs) == gdf.crs
-
-            # Crop images of all plots, distinguished by id
-            for id in gdf['id']:
-                crop_plot(gdf, id, src, plots_directory)
-
-                image_rotated = dictionary['image_correction']['image_rotated']
-
-                if not image_rotated:
-                    image_name = plots_directory + f"plot_{id}.tif"
-                else:
-                    rotate_plot(plots_directory, id)
-                    image_name = plots_directory + f"plot_{id}_rotated_cropped.tif"
-                    
-                if not total_pixel_set:
-                    im = Image.open(image_name)
-                    size = im.size
-                    total_pixel = size[0] * size[1]
-                    total_pixel_set = True
-
-                result = mask_image(image_name)
-                percent = get_pixel_percent(result, total_pixel)
-
-                if args.verbose:
-                    string = f"""
-                    ID:               {id}
-                    date:             {date}
-                    total pixels:     {total_pixel}
-                    pixel-percentage: {percent}
-                    """
-                
-                    print(string)
-
-                df.loc[len(df.index)] = [date, id, percent]
-
-        
-    write_to_file(df)
+    # Extract every plot's geometry once instead of serializing the matching
+    # gdf row to json and back for each plot on each scan-date
+    geom_by_id = dict(zip(gdf['id'], gdf.geometry.map(mapping)))
+
+    dates_dir = dictionary['files']['dates_dir']
+    csv_name = dictionary['files']['csv_name']
+
+    # Stream each result row straight to the csv instead of buffering the
+    # whole run in a DataFrame; the leading index column matches the layout
+    # pandas used to write
+    with open(dates_dir + "/" + csv_name, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["", "Date", "ID", "Percentage"])
+        row_index = 0
+
+        # loop over all the scan-dates
+        for raster_image_path in images:
+            date = np.datetime64(os.path.basename(os.path.dirname(raster_image_path)))
+            plots_directory = os.path.dirname(raster_image_path) + plots_dir_name
+
+            if not os.path.exists(plots_directory):
+                os.makedirs(plots_directory)
+
+            with rasterio.open(raster_image_path) as src:
+                # Check if the CRS match
+                assert str(src.crs) == gdf.crs
+
+                # Size the workers' shared read buffer to the largest plot
+                # window on this raster
+                max_height, max_width = 0, 0
+                for geom in geom_by_id.values():
+                    window = rasterio.windows.from_bounds(
+                        *rasterio.features.bounds(geom), transform=src.transform)
+                    window = window.round_offsets().round_lengths()
+                    max_height = max(max_height, int(window.height))
+                    max_width = max(max_width, int(window.width))
+
+                buffer_shape = (src.count, max_height, max_width)
+                buffer_dtype = src.dtypes[0]
+
+            # Each plot is an independent crop+mask+count, so fan the per-plot
+            # work out over worker processes and collect the counts in order;
+            # each worker opens the raster once for the whole scan-date
+            ids = list(gdf['id'])
+            with ProcessPoolExecutor(initializer=init_worker,
+                                     initargs=(raster_image_path, buffer_shape,
+                                               buffer_dtype)) as executor:
+                results = executor.map(process_plot,
+                                       ids,
+                                       (geom_by_id[id] for id in ids),
+                                       repeat(plots_directory),
+                                       repeat(lower),
+                                       repeat(upper),
+                                       repeat(image_rotated),
+                                       repeat(args.verbose))
+
+                for id, count, total_pixel in results:
+                    # A degenerate (sliver) polygon can overlap the raster
+                    # without covering any pixel center; emit an empty
+                    # percentage instead of dividing by zero
+                    if total_pixel == 0:
+                        print(f"Warning: plot {id} on {date} covers no raster pixels",
+                              file=sys.stderr)
+
+                        writer.writerow([row_index, date, id, ""])
+                        row_index += 1
+                        continue
+
+                    # calculate percentage against the plot's own pixel area
+                    # rather than the first processed plot's size
+                    percent = count/total_pixel*100
+
+                    if args.verbose:
+                        string = f"""
+                        ID:               {id}
+                        date:             {date}
+                        total pixels:     {total_pixel}
+                        pixel-percentage: {percent}
+                        """
+
+                        print(string)
+
+                    writer.writerow([row_index, date, id, percent])
+                    row_index += 1
 
 
 if __name__ == "__main__":